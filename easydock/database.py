@@ -2,8 +2,9 @@ import os
 import sqlite3
 import sys
 import tempfile
+import zlib
 from copy import deepcopy
-from functools import partial
+from functools import lru_cache, partial
 from multiprocessing import Pool
 from typing import Optional, Union
 import yaml
@@ -17,6 +18,56 @@ from rdkit.Chem.EnumerateStereoisomers import EnumerateStereoisomers, StereoEnum
 from rdkit.Chem.SaltRemover import SaltRemover
 
 
+def set_pragmas(db_conn):
+    """
+    Tune connection settings to speed up bulk reading and writing. Journal mode is not changed, because WAL mode is
+    persistent and does not work reliably on network file systems which are common on clusters. Synchronous mode is
+    kept at its default, NORMAL is not safe against power loss in rollback journal mode
+    :param db_conn: connection to DB
+    :return:
+    """
+    db_conn.execute('PRAGMA temp_store = MEMORY')
+    db_conn.execute('PRAGMA cache_size = -200000')
+
+
+# fields with MOL and PDBQT blocks which can be stored compressed
+COMPRESSIBLE_FIELDS = ('source_mol_block_input', 'source_mol_block', 'source_mol_block_protonated', 'pdb_block',
+                       'mol_block')
+
+
+def compress_block(block):
+    """
+    Compress a text block (MOL, PDBQT) to be stored in DB as BLOB
+    :param block: string or None
+    :return: bytes or None
+    """
+    if block is None:
+        return None
+    return zlib.compress(block.encode(), 1)
+
+
+def decompress_block(block):
+    """
+    Returns a text block retrieved from DB. Compressed blocks are stored as BLOB (bytes), uncompressed ones as TEXT,
+    therefore DBs with and without compression can be read in the same way
+    :param block: bytes, string or None
+    :return: string or None
+    """
+    if isinstance(block, bytes):
+        return zlib.decompress(block).decode()
+    return block
+
+
+def compress_data(data):
+    """
+    Compress values of fields containing MOL and PDBQT blocks in a dict of values to update DB
+    :param data: dict of column names and values
+    :return: a new dict
+    """
+    return {k: compress_block(v) if k in COMPRESSIBLE_FIELDS and isinstance(v, str) else v
+            for k, v in data.items()}
+
+
 def create_db(db_fname, args, args_to_save=(), config_args_to_save=('protein', 'protein_setup'), unique_smi=False):
     """
     Create empty database structure and the setup table, which is filled with values. To setup table two fields are
@@ -100,7 +151,7 @@ def restore_setup_from_db(db_fname):
     cur = conn.cursor()
     res = cur.execute('SELECT * FROM setup')
     colnames = [d[0] for d in res.description]
-    values = [v for v in res][0]
+    values = res.fetchone()
     values = dict(zip(colnames, values))
     conn.close()
 
@@ -197,25 +248,38 @@ def generate_init_data(mol_input: tuple[Chem.Mol, str], max_stereoisomers: int,
 def init_db(db_fname: str, input_fname: str, ncpu: int, max_stereoisomers=1, prefix: str=None):
     Chem.SetDefaultPickleProperties(Chem.PropertyPickleOptions.AllProps)
 
-    pool = Pool(processes=ncpu)
     conn = sqlite3.connect(db_fname)
+    set_pragmas(conn)
     cur = conn.cursor()
-    data_smi = []  # non 3D structures
-    data_mol = []  # 3D structures
+    compress = get_compression_arg_value(conn)
     load_data_params = partial(generate_init_data, max_stereoisomers=max_stereoisomers, prefix=prefix)
-    data_list = pool.map(load_data_params, read_input.read_input(input_fname), chunksize=1)
-
-    for item in data_list:
-        if item is not None:
-            for input_format, data in item:
-                if input_format == 'smi':
-                    data_smi.append(data)
-                elif input_format == 'mol':
-                    data_mol.append(data)
-
-    cur.executemany(f'INSERT INTO mols (id, stereo_id, smi_input, smi) VALUES(?, ?, ?, ?)', data_smi)
-    cur.executemany(f'INSERT INTO mols (id, stereo_id, smi, source_mol_block_input, source_mol_block) VALUES(?, ?, ?, ?, ?)', data_mol)
-    conn.commit()
+
+    insert_sql = 'INSERT INTO mols (id, stereo_id, smi_input, smi, source_mol_block_input, source_mol_block) ' \
+                 'VALUES(?, ?, ?, ?, ?, ?)'
+
+    try:
+        # workers are not recycled (no maxtasksperchild): imap reads the input in the pool's task handler thread
+        # and forking replacement workers while it parses input is unsafe
+        with Pool(processes=ncpu) as pool, conn:  # a single transaction for all inserts
+            # both non 3D and 3D structures are normalized to the same set of columns to be inserted at once,
+            # results are streamed from the pool and inserted in batches while workers continue processing
+            data = []
+            for item in pool.imap(load_data_params, read_input.read_input(input_fname), chunksize=32):
+                if item is not None:
+                    for input_format, values in item:
+                        if input_format == 'smi':
+                            data.append(tuple(values) + (None, None))
+                        elif input_format == 'mol':
+                            mol_name, stereo_id, smi, mol_block_input, mol_block = values
+                            if compress:
+                                mol_block_input, mol_block = compress_block(mol_block_input), compress_block(mol_block)
+                            data.append((mol_name, stereo_id, None, smi, mol_block_input, mol_block))
+                if len(data) >= 500:
+                    cur.executemany(insert_sql, data)
+                    data = []
+            cur.executemany(insert_sql, data)
+    finally:
+        conn.close()
 
 
 def get_protonation_arg_value(db_conn):
@@ -228,6 +292,16 @@ def get_protonation_arg_value(db_conn):
     return d['protonation'] is not None
 
 
+def get_compression_arg_value(db_conn):
+    """
+    Returns True if MOL and PDBQT blocks have to be stored compressed and False otherwise
+    :param db_conn:
+    :return:
+    """
+    d = yaml.safe_load(db_conn.execute("SELECT yaml FROM setup").fetchone()[0])
+    return bool(d.get('compress', False))
+
+
 def update_db(db_conn, mol_id, data, table_name='mols', commit=True):
     """
 
@@ -276,30 +350,37 @@ def insert_db(db_fname, data, cols=None, table_name='mols'):
 
 def save_sdf(db_fname):
     sdf_fname = os.path.splitext(db_fname)[0] + '.sdf'
-    with open(sdf_fname, 'wt') as w:
-        conn = sqlite3.connect(db_fname)
-        cur = conn.cursor()
-        for mol_block, mol_name, score in cur.execute('SELECT mol_block, id, MIN(docking_score) '
-                                                      'FROM mols '
-                                                      'WHERE docking_score IS NOT NULL '
-                                                      'AND mol_block IS NOT NULL GROUP BY id'):
-            # update mol name in mol block by removing stereo_id
-            mol_id, mol_block = mol_block.split('\n', 1)
-            mol_block = mol_id.rsplit('_', 1)[0] + '\n' + mol_block
-            w.write(mol_block + '\n')
-            w.write(f'>  <ID>\n{mol_name}\n\n')
-            w.write(f'>  <docking_score>\n{score}\n\n')
-            w.write('$$$$\n')
-        sys.stderr.write(f'Best poses were saved to {sdf_fname}\n')
-
-
-def select_mols_to_dock(db_conn, table_name='mols', add_sql=None):
+    conn = sqlite3.connect(db_fname)
+    try:
+        # a large output buffer and a single writelines call per pose reduce the number of write calls
+        with open(sdf_fname, 'wb', buffering=1 << 20) as w:
+            cur = conn.cursor()
+            for mol_block, mol_name, score in cur.execute('SELECT mol_block, id, MIN(docking_score) '
+                                                          'FROM mols '
+                                                          'WHERE docking_score IS NOT NULL '
+                                                          'AND mol_block IS NOT NULL GROUP BY id'):
+                # update mol name in mol block by removing stereo_id
+                mol_id, mol_block = decompress_block(mol_block).split('\n', 1)
+                w.writelines([mol_id.rsplit('_', 1)[0].encode(), b'\n', mol_block.encode(),
+                              b'\n>  <ID>\n', mol_name.encode(),
+                              b'\n\n>  <docking_score>\n', str(score).encode(),
+                              b'\n\n$$$$\n'])
+            sys.stderr.write(f'Best poses were saved to {sdf_fname}\n')
+    finally:
+        conn.close()
+
+
+def select_mols_to_dock(db_conn, table_name='mols', add_sql=None, duplicates=None):
     """
     Select molecules for docking from a given table using additional selection conditions
     :param db_conn:
     :param table_name:
     :param add_sql: additional SQL query which is appended the SQL query which returns molecules for docking,
                     e.g. "AND id IN ('MOL1', 'MOL2')" or "AND iteration=(SELECT MAX(iteration) FROM mols)"
+    :param duplicates: if a dict is supplied, molecules without 3D structures which have the same SMILES as
+                       a previously selected molecule are not returned, instead their names are stored in this dict
+                       {selected_mol_name: [duplicated_mol_name, ...]} to copy docking results with
+                       copy_docking_results
     :return: list of tuples (mol_id, smi) or (mol_id, mol_block). They can be mixed if the DB is not consistently
              filled, but this is not an issue if use proper parsing function
     """
@@ -315,17 +396,67 @@ def select_mols_to_dock(db_conn, table_name='mols', add_sql=None):
                      ({mol_field_name} IS NOT NULL AND {mol_field_name != ''})) """
     if isinstance(add_sql, str) and add_sql:
         sql += add_sql
+    selected_smi = {}
     for mol_id, stereo_id, smi, mol_block in cur.execute(sql):
+        if mol_block is None and duplicates is not None:
+            mol_name = mol_id + '_' + stereo_id
+            if smi in selected_smi:
+                duplicates.setdefault(selected_smi[smi], []).append(mol_name)
+                continue
+            selected_smi[smi] = mol_name
         if mol_block is None:
             mol = Chem.MolFromSmiles(smi)
         else:
-            mol = Chem.MolFromMolBlock(mol_block, removeHs=False)
+            mol = Chem.MolFromMolBlock(decompress_block(mol_block), removeHs=False)
         if mol:
             mol.SetProp('_Name', mol_id + '_' + stereo_id)
             yield mol
 
 
-def add_protonation(db_fname, program='chemaxon', tautomerize=True, table_name='mols', add_sql='', ncpu=1):
+def copy_docking_results(db_conn, mol_id, dest_mol_ids, table_name='mols',
+                         fields=('docking_score', 'pdb_block', 'mol_block')):
+    """
+    Copy docking results of a molecule to other molecules, e.g. those having identical SMILES. Titles of mol blocks
+    are replaced with names of destination molecules. Nothing is copied if the source molecule was not docked.
+    dock_time is not copied by default and remains NULL for destination molecules, because they were not docked.
+    :param db_conn:
+    :param mol_id: id of a docked molecule with stereo_id suffix
+    :param dest_mol_ids: list of ids of molecules with stereo_id suffixes to which results should be copied
+    :param table_name:
+    :param fields: names of fields to copy
+    :return:
+    """
+    mol_id, stereo_id = mol_name_split(mol_id)
+    res = db_conn.execute(f"""SELECT {', '.join(fields)} 
+                              FROM {table_name} 
+                              WHERE id = ? AND stereo_id = ? AND docking_score IS NOT NULL""",
+                          (mol_id, stereo_id)).fetchone()
+    if res is None:
+        return
+    data = dict(zip(fields, res))
+    for dest_mol_id in dest_mol_ids:
+        dest_data = dict(data)
+        if dest_data.get('mol_block'):
+            mol_block = dest_mol_id + '\n' + decompress_block(dest_data['mol_block']).split('\n', 1)[1]
+            dest_data['mol_block'] = compress_block(mol_block) if isinstance(data['mol_block'], bytes) else mol_block
+        update_db(db_conn, dest_mol_id, dest_data, table_name=table_name, commit=False)
+    db_conn.commit()
+
+
+@lru_cache(maxsize=200000)
+def __canon_smi(smi):
+    """
+    Returns canonical SMILES or None if the input SMILES cannot be parsed. Results are cached, because the same
+    structures may recur in a library, e.g. identical protonation states of different input molecules
+    :param smi: SMILES
+    :return: canonical isomeric SMILES
+    """
+    mol = Chem.MolFromSmiles(smi)
+    return Chem.MolToSmiles(mol) if mol is not None else None
+
+
+def add_protonation(db_fname, program='chemaxon', tautomerize=True, table_name='mols', add_sql='', ncpu=1,
+                    canonicalize=True):
     '''
     Protonate SMILES by Chemaxon cxcalc utility to get molecule ionization states at pH 7.4
     :param db_fname:
@@ -334,40 +465,48 @@ def add_protonation(db_fname, program='chemaxon', tautomerize=True, table_name='
     :param table_name: table name with molecules to protonate
     :param add_sql: additional SQL query to be appended to the SQL query to retrieve molecules for protonation,
                     e.g. "AND id IN ('MOL1', 'MOL2')" or "AND iteration=(SELECT MAX(iteration) FROM mols)".
+    :param canonicalize: canonicalize SMILES returned by a protonation program with RDKit. If False, SMILES of
+                         molecules without 3D structures are stored as returned by the program without validation
     :return:
     '''
     conn = sqlite3.connect(db_fname)
+    set_pragmas(conn)
 
     try:
         cur = conn.cursor()
+        compress = get_compression_arg_value(conn)
 
-        # SMiLES only
-        sql = f"""SELECT smi, id || '_' || stereo_id 
-                  FROM {table_name} 
-                  WHERE docking_score is NULL AND smi_protonated is NULL AND source_mol_block is NULL """
-        sql += add_sql
-        data_list_smi = list(cur.execute(sql))
-
-        # mol_block only
-        sql = f"""SELECT smi, id || '_' || stereo_id 
-                  FROM {table_name} 
-                  WHERE docking_score is NULL AND smi_protonated is NULL AND source_mol_block is NOT NULL """
-        sql += add_sql
-        data_list_mol = list(cur.execute(sql))
-
-        if not data_list_smi and not data_list_mol:
-            sys.stderr.write(f'no molecules to protonate\n')
-            return
-
-        smi_names = set(mol_name for smi, mol_name in data_list_smi)
-        mol_names = set(mol_name for smi, mol_name in data_list_mol)
+        # 'smi' - only SMILES are available, 'mol' - 3D structure is available
+        mol_kinds = {}
 
         output_data_smi = []
         output_data_mol = []
 
         with tempfile.NamedTemporaryFile(suffix='.smi', mode='w', encoding='utf-8') as tmp:
-            for smi, mol_name in data_list_smi + data_list_mol:
+
+            # selected rows are streamed to the input file without materializing them in memory
+            # SMiLES only
+            sql = f"""SELECT smi, id || '_' || stereo_id 
+                      FROM {table_name} 
+                      WHERE docking_score is NULL AND smi_protonated is NULL AND source_mol_block is NULL """
+            sql += add_sql
+            for smi, mol_name in cur.execute(sql):
+                mol_kinds[mol_name] = 'smi'
+                tmp.write(f'{smi}\t{mol_name}\n')
+
+            # mol_block only
+            sql = f"""SELECT smi, id || '_' || stereo_id 
+                      FROM {table_name} 
+                      WHERE docking_score is NULL AND smi_protonated is NULL AND source_mol_block is NOT NULL """
+            sql += add_sql
+            for smi, mol_name in cur.execute(sql):
+                mol_kinds[mol_name] = 'mol'
                 tmp.write(f'{smi}\t{mol_name}\n')
+
+            if not mol_kinds:
+                sys.stderr.write(f'no molecules to protonate\n')
+                return
+
             tmp.flush()
 
             fd, output = tempfile.mkstemp()  # use output file to avoid overflow of stdout in extreme cases
@@ -391,18 +530,32 @@ def add_protonation(db_fname, program='chemaxon', tautomerize=True, table_name='
 
                 for smi, mol_name in read_func(output):
 
-                    try:
-                        cansmi = Chem.CanonSmiles(smi)
-                    except:
+                    mol_kind = mol_kinds.get(mol_name)
+                    if mol_kind is None:
+                        continue
+
+                    # SMILES is parsed once and the parsed molecule is reused as a template for 3D structures
+                    if mol_kind == 'mol':
+                        ref_mol = Chem.MolFromSmiles(smi)
+                        if ref_mol is None:
+                            cansmi = None
+                        else:
+                            cansmi = Chem.MolToSmiles(ref_mol) if canonicalize else smi
+                    elif canonicalize:
+                        cansmi = __canon_smi(smi)
+                    else:
+                        cansmi = smi
+
+                    if cansmi is None:
                         sys.stderr.write(f'EASYDOCK ERROR: {mol_name}, smiles {smi} obtained after protonation '
                                          f'could not be read by RDKit. The molecule was skipped.\n')
                         continue
 
                     mol_id, stereo_id = mol_name_split(mol_name)
 
-                    if mol_name in smi_names:
+                    if mol_kind == 'smi':
                         output_data_smi.append((cansmi, mol_id, stereo_id))
-                    elif mol_name in mol_names:
+                    else:
                         try:
                             # mol block in chemaxon sdf is an input molecule but with 2D structure
                             # because input is SMILES
@@ -410,13 +563,16 @@ def add_protonation(db_fname, program='chemaxon', tautomerize=True, table_name='
                             # remove Hs and assign bond orders from SMILES
                             # this should work even if a generated tautomer differs from the input molecule
                             mol3d = get_mol(conn, mol_id, stereo_id, field_name='source_mol_block')
-                            mol3d = Chem.RemoveHs(Chem.RWMol(mol3d))
+                            mol3d = Chem.RemoveHs(mol3d)  # returns a new molecule, bond types can be changed in place
                             for b in mol3d.GetBonds():
                                 b.SetBondType(Chem.BondType.SINGLE)
-                            ref_mol = Chem.RemoveHs(Chem.MolFromSmiles(cansmi))
+                            ref_mol = Chem.RemoveHs(ref_mol)
                             mol = AllChem.AssignBondOrdersFromTemplate(ref_mol, mol3d)
                             Chem.AssignStereochemistryFrom3D(mol)  # not sure whether it is necessary
-                            output_data_mol.append((cansmi, Chem.MolToMolBlock(mol), mol_id, stereo_id))
+                            mol_block = Chem.MolToMolBlock(mol)
+                            if compress:
+                                mol_block = compress_block(mol_block)
+                            output_data_mol.append((cansmi, mol_block, mol_id, stereo_id))
                         except ValueError:
                             continue
 
@@ -424,6 +580,7 @@ def add_protonation(db_fname, program='chemaxon', tautomerize=True, table_name='
                 os.remove(output)
                 os.close(fd)
 
+        # a single transaction for all updates
         cur.executemany(f"""UPDATE {table_name}
                        SET 
                            smi_protonated = ?
@@ -487,7 +644,7 @@ def get_mols(conn, mol_ids, field_name='mol_block'):
 
     mols = []
     for items in select_from_db(cur, sql, mol_ids):
-        m = func(items[0])
+        m = func(decompress_block(items[0]))
         if m:
             Chem.AssignStereochemistryFrom3D(m)
             mols.append(m)
@@ -515,5 +672,5 @@ def get_mol(conn, mol_id, stereo_id, field_name='mol_block'):
     cur = conn.cursor()
     sql = f'SELECT {field_name} FROM mols WHERE id = ? AND stereo_id = ? AND {field_name} IS NOT NULL'
     res = cur.execute(sql, (mol_id, stereo_id))
-    mol = func(res.fetchone()[0])
+    mol = func(decompress_block(res.fetchone()[0]))
     return mol
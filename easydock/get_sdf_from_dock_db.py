@@ -6,7 +6,8 @@ import sqlite3
 import sys
 from rdkit import Chem
 
-from .preparation_for_docking import pdbqt2molblock
+from .database import decompress_block
+from .preparation_for_docking import pdbqt2molblock, prepare_template
 
 
 def main():
@@ -98,6 +99,7 @@ def main():
 
     with open(args.output, 'wt')as f:
         for item in res:  # (mol_block, ...)
+            item = [decompress_block(value) for value in item]  # blocks can be stored compressed
             if ext == 'sdf':
                 mol_block = item[0]
                 mol_id = mol_block.split('\n', 1)[0]
@@ -122,9 +124,12 @@ def main():
                 if poses:
                     pdb_block_list = item[1:][args.fields.index('pdb_block')].strip().split('ENDMDL')
                     mol = Chem.MolFromMolBlock(mol_block)
+                    # the template is prepared once for all poses of the molecule
+                    prepared_template = prepare_template(mol) if mol is not None else None
                     for i in poses:  # 1-based
                         try:
-                            pose_mol_block = pdbqt2molblock(pdb_block_list[i-1] + 'ENDMDL\n', mol, mol_id + f'_{i}')
+                            pose_mol_block = pdbqt2molblock(pdb_block_list[i-1] + 'ENDMDL\n', mol, mol_id + f'_{i}',
+                                                            prepared_template=prepared_template)
                         except IndexError:
                             sys.stderr.write(f'Pose number {i} is not in the PDB block of {mol_id}. '
                                              f'It will be skipped.\n')
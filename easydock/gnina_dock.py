@@ -3,6 +3,7 @@
 import argparse
 import os
 import re
+import shlex
 import sys
 import tempfile
 import timeit
@@ -12,6 +13,10 @@ import yaml
 from easydock.preparation_for_docking import ligand_preparation, pdbqt2molblock
 
 
+_CNN_AFFINITY_PATTERN = re.compile(r'REMARK CNNaffinity\s+([\d.]+)')
+_MINIMIZED_AFFINITY_PATTERN = re.compile(r'REMARK minimizedAffinity\s+(-?[\d.]+)')
+
+
 class RawTextArgumentDefaultsHelpFormatter(argparse.RawTextHelpFormatter, argparse.ArgumentDefaultsHelpFormatter):
     pass
 
@@ -19,11 +24,11 @@ class RawTextArgumentDefaultsHelpFormatter(argparse.RawTextHelpFormatter, argpar
 def __get_pdbqt_and_score(ligand_out_fname):
     with open(ligand_out_fname) as f:
         pdbqt_out = f.read()
-    match = re.search(r'REMARK CNNaffinity\s+([\d.]+)', pdbqt_out)
+    match = _CNN_AFFINITY_PATTERN.search(pdbqt_out)
     if match:
         score = round(float(match.group(1)), 3)
     else:
-        match = re.search(r'REMARK minimizedAffinity\s+(-?[\d.]+)', pdbqt_out)
+        match = _MINIMIZED_AFFINITY_PATTERN.search(pdbqt_out)
         score = round(float(match.group(1)), 3)
 
     return score, pdbqt_out
@@ -43,7 +48,8 @@ def mol_dock(mol, config):
 
     mol_id = mol.GetProp('_Name')
     boron_replacement = config["cnn_scoring"] in [None, "none"]
-    ligand_pdbqt = ligand_preparation(mol, boron_replacement=boron_replacement)
+    ligand_pdbqt = ligand_preparation(mol, boron_replacement=boron_replacement, nconfs=config.get('nconfs', 1),
+                                      nthreads=config['ncpu'])
     if ligand_pdbqt is None:
         return mol_id, None
 
@@ -54,17 +60,19 @@ def mol_dock(mol, config):
         with open(ligand_fname, 'wt') as f:
             f.write(ligand_pdbqt)
 
-        cmd = f'{config["script_file"]} --receptor {config["protein"]} --ligand {ligand_fname} --out {output_fname} ' \
-              f'--config {config["protein_setup"]} --exhaustiveness {config["exhaustiveness"]} ' \
-              f'--seed {config["seed"]} --scoring {config["scoring"]} ' \
-              f'--cpu {config["ncpu"]} --addH {config["addH"]} --cnn_scoring {config["cnn_scoring"]} ' \
-              f'--cnn {config["cnn"]} --num_modes {config["n_poses"]}'
+        # script_file is split to support executables called with additional arguments, e.g. containers
+        cmd = [*shlex.split(config["script_file"]), '--receptor', config["protein"], '--ligand', ligand_fname,
+               '--out', output_fname, '--config', config["protein_setup"],
+               '--exhaustiveness', str(config["exhaustiveness"]), '--seed', str(config["seed"]),
+               '--scoring', str(config["scoring"]), '--cpu', str(config["ncpu"]), '--addH', str(config["addH"]),
+               '--cnn_scoring', str(config["cnn_scoring"]), '--cnn', str(config["cnn"]),
+               '--num_modes', str(config["n_poses"])]
         start_time = timeit.default_timer()
-        subprocess.run(cmd, shell=True, check=True, capture_output=True, text=True)  # this will trigger CalledProcessError and skip next lines
+        subprocess.run(cmd, check=True, capture_output=True, text=True)  # this will trigger CalledProcessError and skip next lines
         dock_time = round(timeit.default_timer() - start_time, 1)
 
         score, pdbqt_out = __get_pdbqt_and_score(output_fname)
-        mol_block = pdbqt2molblock(pdbqt_out.split('MODEL')[1], mol, mol_id)
+        mol_block = pdbqt2molblock(pdbqt_out.split('MODEL', 2)[1], mol, mol_id)
 
         output = {'docking_score': score,
                   'pdb_block': pdbqt_out,
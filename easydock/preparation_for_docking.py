@@ -2,6 +2,7 @@ import os
 import re
 import sys
 import traceback
+from functools import lru_cache
 from multiprocessing import cpu_count
 
 from meeko import (MoleculePreparation, PDBQTMolecule, PDBQTWriterLegacy,
@@ -10,6 +11,9 @@ from rdkit import Chem
 from rdkit.Chem import AllChem
 
 
+_BORON_PAT = Chem.MolFromSmarts('[#5]')
+
+
 def cpu_type(x):
     return max(1, min(int(x), cpu_count()))
 
@@ -52,18 +56,52 @@ def mk_prepare_ligand(mol, verbose=False):
     return pdbqt_string
 
 
-def mol_embedding_3d(mol, seed=43):
+@lru_cache(maxsize=None)
+def __get_etkdg_params(use_random_coords, random_seed, nthreads=1):
+    # parameters are created once per process and combination of arguments and are not modified afterwards,
+    # so they can be safely shared between threads
+    params = AllChem.ETKDGv3()
+    params.useRandomCoords = use_random_coords
+    params.randomSeed = random_seed
+    params.numThreads = nthreads
+    return params
+
+
+def __embed_best_conformer(mol, nconfs, seed, optimize, nthreads):
+    """
+    Generate several conformers using multiple threads and keep only the one with the lowest UFF energy.
+    If optimization is disabled, conformers are ranked by single point UFF energies
+    :return: Mol with a single conformer or None if embedding failed
+    """
+    conf_ids = list(AllChem.EmbedMultipleConfs(mol, nconfs, __get_etkdg_params(False, seed, nthreads)))
+    if not conf_ids:
+        conf_ids = list(AllChem.EmbedMultipleConfs(mol, nconfs, __get_etkdg_params(True, seed, nthreads)))
+        if not conf_ids:
+            return None
+    if optimize:
+        # list of (not_converged, energy) in the order of conformers
+        res = AllChem.UFFOptimizeMoleculeConfs(mol, numThreads=nthreads, maxIters=100)
+        energies = [energy for not_converged, energy in res]
+    else:
+        energies = [AllChem.UFFGetMoleculeForceField(mol, confId=i).CalcEnergy() for i in conf_ids]
+    best_id = conf_ids[min(range(len(energies)), key=lambda i: energies[i])]
+    conf = Chem.Conformer(mol.GetConformer(best_id))
+    mol.RemoveAllConformers()
+    mol.AddConformer(conf, assignId=True)
+    return mol
+
+
+def mol_embedding_3d(mol, seed=43, optimize=True, nconfs=1, nthreads=1):
 
     def gen_conf(mole, useRandomCoords, randomSeed):
-        params = AllChem.ETKDGv3()
-        params.useRandomCoords = useRandomCoords
-        params.randomSeed = randomSeed
-        conf_stat = AllChem.EmbedMolecule(mole, params)
+        conf_stat = AllChem.EmbedMolecule(mole, __get_etkdg_params(useRandomCoords, randomSeed))
         return mole, conf_stat
 
     if not isinstance(mol, Chem.Mol):
         return None
     mol = Chem.AddHs(mol, addCoords=True)
+    if not mol_is_3d(mol) and nconfs > 1:  # useful for large flexible molecules
+        return __embed_best_conformer(mol, nconfs, seed, optimize, nthreads)
     if not mol_is_3d(mol):  # only for non 3D input structures
         mol, conf_stat = gen_conf(mol, useRandomCoords=False, randomSeed=seed)
         if conf_stat == -1:
@@ -71,25 +109,29 @@ def mol_embedding_3d(mol, seed=43):
             mol, conf_stat = gen_conf(mol, useRandomCoords=True, randomSeed=seed)
             if conf_stat == -1:
                 return None
-        AllChem.UFFOptimizeMolecule(mol, maxIters=100)
+        if optimize:
+            AllChem.UFFOptimizeMolecule(mol, maxIters=100)
     return mol
 
 
-def ligand_preparation(mol, boron_replacement=False, seed=43):
+def ligand_preparation(mol, boron_replacement=False, seed=43, optimize=True, nconfs=1, nthreads=1):
     """
     If input ligand is not a 3D structure a conformer will be generated by RDKit, otherwise the provided 3D structure
     will be used. Boron atoms are replaced with carbon to enable docking using Vina and gnina
     :param mol:
     :param boron_replacement: indicate to whether replace boron with carbon atoms or not
     :param seed: fixed to 43 to generate consistent random stereoisomers for compounds with undefined stereocenters
+    :param optimize: optimize generated conformers with UFF, ETKDG conformers are usually reasonable without it
+    :param nconfs: number of conformers to generate for non 3D structures, the one with the lowest energy is used
+    :param nthreads: number of threads used to generate and optimize multiple conformers, 0 - all available
     :return: PDBQT block
     """
 
     try:
-        mol = mol_embedding_3d(mol, seed=seed)
+        mol = mol_embedding_3d(mol, seed=seed, optimize=optimize, nconfs=nconfs, nthreads=nthreads)
         if mol:
             if boron_replacement:
-                idx_boron = [a.GetIdx() for a in mol.GetAtoms() if a.GetAtomicNum() == 5]
+                idx_boron = [ids[0] for ids in mol.GetSubstructMatches(_BORON_PAT)]
                 for id_ in idx_boron:
                     if mol.GetAtomWithIdx(id_).GetFormalCharge() < 0:
                         mol.GetAtomWithIdx(id_).SetFormalCharge(0)
@@ -102,15 +144,26 @@ def ligand_preparation(mol, boron_replacement=False, seed=43):
         return None
 
 
-def assign_bonds_from_template(template_mol, mol):
+def prepare_template(template_mol):
+    """
+    Prepare a template molecule to assign bond orders to docked poses. It can be called once per molecule
+    and reused for all its poses
+    :param template_mol: Mol of a reference structure
+    :return: a new Mol with explicit hydrogens on heteroatoms
+    """
     # explicit hydrogends are removed from carbon atoms (chiral hydrogens) to match pdbqt mol,
     # e.g. [NH3+][C@H](C)C(=O)[O-]
-    template_mol_ = Chem.Mol(template_mol)
-    template_mol_ = Chem.AddHs(template_mol_, explicitOnly=True,
-                               onlyOnAtoms=[a.GetIdx() for a in template_mol_.GetAtoms() if
-                                            a.GetAtomicNum() != 6])
-    mol = AllChem.AssignBondOrdersFromTemplate(template_mol_, mol)
-    Chem.SanitizeMol(mol)
+    return Chem.AddHs(template_mol, explicitOnly=True,
+                      onlyOnAtoms=[a.GetIdx() for a in template_mol.GetAtoms() if a.GetAtomicNum() != 6])
+
+
+def assign_bonds_from_template(template_mol, mol, template_prepared=False):
+    if not template_prepared:
+        template_mol = prepare_template(template_mol)
+    # no explicit sanitization: AssignBondOrdersFromTemplate sanitizes the molecule only if bond orders had to be
+    # reassigned, otherwise it returns a copy of the input molecule. Poses created by Meeko (RDKitMolCreate) are
+    # already sanitized, callers supplying other molecules should sanitize them beforehand
+    mol = AllChem.AssignBondOrdersFromTemplate(template_mol, mol)
     Chem.AssignStereochemistry(mol, cleanIt=True, force=True, flagPossibleStereoCenters=True)
     return mol
 
@@ -119,7 +172,8 @@ def boron_reduction(mol_B, mol):
     mol_B_ = Chem.Mol(mol_B)
     mol_ = Chem.Mol(mol)
 
-    idx_boron = {a.GetIdx(): a.GetFormalCharge() for a in mol_B_.GetAtoms() if a.GetAtomicNum() == 5}
+    idx_boron = {ids[0]: mol_B_.GetAtomWithIdx(ids[0]).GetFormalCharge()
+                 for ids in mol_B_.GetSubstructMatches(_BORON_PAT)}
     if idx_boron:
 
         for id_, charge in idx_boron.items():
@@ -142,13 +196,16 @@ def boron_reduction(mol_B, mol):
     return mol_
 
 
-def pdbqt2molblock(pdbqt_block, template_mol, mol_id):
+def pdbqt2molblock(pdbqt_block, template_mol, mol_id, prepared_template=None):
     """
     The function takes PDBQT block with one or more poses and converts top pose to MDL MOL format. The function tries
     to return back boron atoms
     :param pdbqt_block: a single string with a single PDBQT block (a single pose)
     :param template_mol: Mol of a reference structure to assign bond orders
     :param mol_id: name of a molecule which will be added as a title in the output MOL block
+    :param prepared_template: template_mol processed by prepare_template, may be supplied to avoid its repeated
+                              preparation if multiple poses of the same molecule are converted. It is not used for
+                              boron-containing molecules
     :param boron_replacement: indicate whether to try to return boron atoms instead af carbon ones
     :return: a single string with a MOL block, if conversion failed returns None
     """
@@ -163,8 +220,10 @@ def pdbqt2molblock(pdbqt_block, template_mol, mol_id):
         return None
 
     try:
-        if 5 in [atom.GetAtomicNum() for atom in template_mol.GetAtoms()]:
+        if template_mol.HasSubstructMatch(_BORON_PAT):
             mol = boron_reduction(template_mol, rdkit_mol)
+        elif prepared_template is not None:
+            mol = assign_bonds_from_template(prepared_template, rdkit_mol, template_prepared=True)
         else:
             mol = assign_bonds_from_template(template_mol, rdkit_mol)
 
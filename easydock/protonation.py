@@ -20,20 +20,24 @@ the protonate_xxx function and returns a generator of tuples (SMILES, mol_name).
 """
 
 
+_PROTONATED_AMIDE_PAT = Chem.MolFromSmarts('[$([NH+]-[*]=O)]')
+
+
 def protonate_chemaxon(input_fname, output_fname, tautomerize=True):
-    cmd_run = ['cxcalc', '-S', '--ignore-error', 'majormicrospecies', '-H', '7.4', '-K',
-               f'{"-M" if tautomerize else ""}', input_fname]
+    cmd_run = ['cxcalc', '-S', '--ignore-error', 'majormicrospecies', '-H', '7.4', '-K']
+    if tautomerize:
+        cmd_run.append('-M')
+    cmd_run.append(input_fname)
     with open(output_fname, 'w') as file:
         subprocess.run(cmd_run, stdout=file, text=True)
 
 
 def read_protonate_chemaxon(fname):
-    for mol in Chem.SDMolSupplier(fname, sanitize=False):
-        if mol:
-            mol_name = mol.GetProp('_Name')
-            smi = mol.GetPropsAsDict().get('MAJORMS', None)
-            if smi is not None:
-                yield smi, mol_name
+    # output is read sequentially, random access provided by SDMolSupplier is not needed
+    with open(fname, 'rb') as f:
+        for mol in Chem.ForwardSDMolSupplier(f, sanitize=False):
+            if mol and mol.HasProp('MAJORMS'):
+                yield mol.GetProp('MAJORMS'), mol.GetProp('_Name')
 
 
 def chunk_into_n(smi_l: list[str], n: int):
@@ -118,7 +122,7 @@ def __protonate_pkasolver(args, model):
             output_mol = states[-1].deprotonated_mol
         # fix protonated amides and analogs (about 2% such structures in 23K molecules)
         output_mol = Chem.RemoveHs(output_mol)
-        ids = output_mol.GetSubstructMatches(Chem.MolFromSmarts('[$([NH+]-[*]=O)]'))
+        ids = output_mol.GetSubstructMatches(_PROTONATED_AMIDE_PAT)
         if ids:
             for i in ids:
                 output_mol.GetAtomWithIdx(i[0]).SetFormalCharge(0)
@@ -11,7 +11,7 @@ from multiprocessing import Pool
 from rdkit import Chem
 from rdkit.Chem.rdMolDescriptors import CalcNumRotatableBonds
 from easydock.database import create_db, restore_setup_from_db, init_db, update_db, save_sdf, select_mols_to_dock, \
-    add_protonation
+    add_protonation, copy_docking_results, compress_data
 from easydock.preparation_for_docking import cpu_type, filepath_type
 
 
@@ -71,7 +71,7 @@ def docking(mols, dock_func, dock_config, priority_func=CalcNumRotatableBonds, n
                 except StopIteration:
                     continue
     else:
-        pool = Pool(ncpu)
+        pool = Pool(ncpu, maxtasksperchild=100)  # restart workers to release memory accumulated by RDKit
         try:
             for mol_id, res in pool.imap_unordered(partial(dock_func, config=dock_config), tuple(mols), chunksize=1):
                 yield mol_id, res
@@ -158,6 +158,10 @@ def main():
                         help='disable tautomerization of molecules during protonation.')
     parser.add_argument('--sdf', action='store_true', default=False,
                         help='save best docked poses to SDF file with the same name as output DB.')
+    parser.add_argument('--compress', action='store_true', default=False,
+                        help='store MOL and PDBQT blocks in the output DB compressed by zlib to reduce its size. '
+                             'Such blocks are stored as BLOB and are decompressed transparently by EasyDock '
+                             'functions and get_sdf_from_dock_db.')
     parser.add_argument('--hostfile', metavar='FILENAME', required=False, type=filepath_type, default=None,
                         help='text file with addresses of nodes of dask SSH cluster. The most typical, it can be '
                              'passed as $PBS_NODEFILE variable from inside a PBS script. The first line in this file '
@@ -229,7 +233,9 @@ def main():
             dask_report_fname = None
 
         with sqlite3.connect(args.output, timeout=60) as conn:
-            mols = select_mols_to_dock(conn)
+            # molecules with identical SMILES are docked once and results are copied to duplicates
+            duplicates = {}
+            mols = select_mols_to_dock(conn, duplicates=duplicates)
             i = 0
             for i, (mol_id, res) in enumerate(docking(mols,
                                                       dock_func=mol_dock,
@@ -240,9 +246,16 @@ def main():
                                                       dask_report_fname=dask_report_fname),
                                               1):
                 if res:
+                    if args.compress:
+                        res = compress_data(res)
                     update_db(conn, mol_id, res)
+                    if mol_id in duplicates:
+                        copy_docking_results(conn, mol_id, duplicates.pop(mol_id))
                 if args.verbose and i % 100 == 0:
                     sys.stderr.write(f'\r{i} molecules were processed')
+            # duplicates which were selected after docking of their reference molecules had been completed
+            for mol_id, dup_mol_ids in duplicates.items():
+                copy_docking_results(conn, mol_id, dup_mol_ids)
             if args.verbose:
                 sys.stderr.write(f'\n{i} molecules were processed\n')
 
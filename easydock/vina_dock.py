@@ -37,7 +37,7 @@ def __docking(ligands_pdbqt_string, receptor_pdbqt_fname, center, box_size, exha
     return v.energies(n_poses=n_poses)[0][0], v.poses(n_poses=n_poses)
 
 
-def mol_dock2(mol, protein, center, box_size, seed, exhaustiveness, n_poses, ncpu):
+def mol_dock2(mol, protein, center, box_size, seed, exhaustiveness, n_poses, ncpu, nconfs=1):
     """
 
     :param mol: RDKit Mol with title
@@ -48,16 +48,17 @@ def mol_dock2(mol, protein, center, box_size, seed, exhaustiveness, n_poses, ncp
     :param exhaustiveness:
     :param n_poses:
     :param ncpu:
+    :param nconfs: number of conformers generated for a non 3D ligand, the one with the lowest energy is docked
     :return:
     """
     mol_id = mol.GetProp('_Name')
-    ligand_pdbqt = ligand_preparation(mol, boron_replacement=True)
+    ligand_pdbqt = ligand_preparation(mol, boron_replacement=True, nconfs=nconfs, nthreads=ncpu)
     if ligand_pdbqt is None:
         return mol_id, None
     score, pdbqt_out = __docking(ligands_pdbqt_string=ligand_pdbqt, receptor_pdbqt_fname=protein,
                                  center=center, box_size=box_size, exhaustiveness=exhaustiveness, seed=seed,
                                  n_poses=n_poses, ncpu=ncpu)
-    mol_block = pdbqt2molblock(pdbqt_out.split('MODEL')[1], mol, mol_id)
+    mol_block = pdbqt2molblock(pdbqt_out.split('MODEL', 2)[1], mol, mol_id)
 
     return mol_id, {'docking_score': score,
                     'pdb_block': pdbqt_out,
@@ -76,7 +77,8 @@ def mol_dock(mol, config):
     config = __parse_config(config)
 
     mol_id = mol.GetProp('_Name')
-    ligand_pdbqt = ligand_preparation(mol, boron_replacement=True)
+    ligand_pdbqt = ligand_preparation(mol, boron_replacement=True, nconfs=config.get('nconfs', 1),
+                                      nthreads=config['ncpu'])
     if ligand_pdbqt is None:
         return mol_id, None
 
@@ -89,19 +91,19 @@ def mol_dock(mol, config):
 
         p = os.path.realpath(__file__)
         python_exec = sys.executable
-        cmd = f'{python_exec} {os.path.dirname(p)}/vina_dock_cli.py -l {ligand_fname} -p {config["protein"]} ' \
-              f'-o {output_fname} --center {" ".join(map(str, config["center"]))} ' \
-              f'--box_size {" ".join(map(str, config["box_size"]))} ' \
-              f'-e {config["exhaustiveness"]} --seed {config["seed"]} --nposes {config["n_poses"]} -c {config["ncpu"]}'
+        cmd = [python_exec, os.path.join(os.path.dirname(p), 'vina_dock_cli.py'), '-l', ligand_fname,
+               '-p', config["protein"], '-o', output_fname, '--center', *map(str, config["center"]),
+               '--box_size', *map(str, config["box_size"]), '-e', str(config["exhaustiveness"]),
+               '--seed', str(config["seed"]), '--nposes', str(config["n_poses"]), '-c', str(config["ncpu"])]
         start_time = timeit.default_timer()
-        subprocess.run(cmd, shell=True, check=True, capture_output=True, text=True)  # this will trigger CalledProcessError and skip next lines)
+        subprocess.run(cmd, check=True, capture_output=True, text=True)  # this will trigger CalledProcessError and skip next lines)
         dock_time = round(timeit.default_timer() - start_time, 1)
 
         with open(output_fname) as f:
             res = f.read()
             if res:
                 res = json.loads(res)
-                mol_block = pdbqt2molblock(res['poses'].split('MODEL')[1], mol, mol_id)
+                mol_block = pdbqt2molblock(res['poses'].split('MODEL', 2)[1], mol, mol_id)
                 output = {'docking_score': res['docking_score'],
                           'pdb_block': res['poses'],
                           'mol_block': mol_block,
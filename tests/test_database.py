@@ -0,0 +1,89 @@
+import sqlite3
+from argparse import Namespace
+
+import pytest
+from rdkit import Chem
+from rdkit.Chem import AllChem
+
+from easydock.database import create_db, init_db, select_mols_to_dock, update_db, copy_docking_results, get_mol, \
+    save_sdf, compress_data
+
+
+def make_db(tmp_path, compress=False):
+    config_fname = tmp_path / 'config.yml'
+    config_fname.write_text('protein: null\nprotein_setup: null\n')
+    db_fname = str(tmp_path / 'output.db')
+    create_db(db_fname, Namespace(config=str(config_fname), protonation=None, compress=compress))
+    return db_fname
+
+
+def test_duplicated_smiles_docked_once(tmp_path):
+    db_fname = make_db(tmp_path)
+    with sqlite3.connect(db_fname) as conn:
+        conn.executemany('INSERT INTO mols (id, stereo_id, smi) VALUES (?, ?, ?)',
+                         [('mol1', 0, 'c1ccccc1O'), ('mol2', 0, 'c1ccccc1O'), ('mol3', 0, 'CCO')])
+        conn.commit()
+
+        duplicates = {}
+        mols = list(select_mols_to_dock(conn, duplicates=duplicates))
+        assert sorted(mol.GetProp('_Name') for mol in mols) == ['mol1_0', 'mol3_0']
+        assert duplicates == {'mol1_0': ['mol2_0']}
+
+        mol = Chem.AddHs(Chem.MolFromSmiles('c1ccccc1O'))
+        mol.SetProp('_Name', 'mol1_0')
+        update_db(conn, 'mol1_0', {'docking_score': -7.5,
+                                   'pdb_block': 'MODEL 1\nENDMDL\n',
+                                   'mol_block': Chem.MolToMolBlock(mol),
+                                   'dock_time': 10.0})
+        copy_docking_results(conn, 'mol1_0', duplicates['mol1_0'])
+
+        score, mol_block, dock_time = conn.execute(
+            "SELECT docking_score, mol_block, dock_time FROM mols WHERE id = 'mol2' AND stereo_id = '0'").fetchone()
+        assert score == pytest.approx(-7.5)
+        assert mol_block.split('\n', 1)[0] == 'mol2_0'
+        assert dock_time is None
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_compressed_blocks_round_trip(tmp_path, compress):
+    db_fname = make_db(tmp_path, compress=compress)
+
+    mol = Chem.AddHs(Chem.MolFromSmiles('CC(=O)Nc1ccccc1'))
+    AllChem.EmbedMolecule(mol, randomSeed=42)
+    mol.SetProp('_Name', 'mol1')
+    # read_input removes explicit hydrogens from the SDF input
+    natoms = Chem.RemoveHs(mol).GetNumAtoms()
+    input_fname = str(tmp_path / 'input.sdf')
+    with Chem.SDWriter(input_fname) as w:
+        w.write(mol)
+
+    init_db(db_fname, input_fname, ncpu=1)
+
+    with sqlite3.connect(db_fname) as conn:
+        mol_block = conn.execute("SELECT source_mol_block FROM mols WHERE id = 'mol1'").fetchone()[0]
+        assert isinstance(mol_block, bytes) == compress
+
+        source_mol = get_mol(conn, 'mol1', '0', field_name='source_mol_block')
+        assert source_mol.GetNumAtoms() == natoms
+
+        mols = list(select_mols_to_dock(conn))
+        assert len(mols) == 1
+        assert mols[0].GetProp('_Name') == 'mol1_0'
+        assert mols[0].GetNumAtoms() == natoms
+
+        docked_mol = Chem.Mol(mols[0])
+        docked_mol.SetProp('_Name', 'mol1_0')
+        res = {'docking_score': -5.0, 'pdb_block': 'MODEL 1\nENDMDL\n', 'mol_block': Chem.MolToMolBlock(docked_mol)}
+        if compress:
+            res = compress_data(res)
+        update_db(conn, 'mol1_0', res)
+
+        mol_block = conn.execute("SELECT mol_block FROM mols WHERE id = 'mol1'").fetchone()[0]
+        assert isinstance(mol_block, bytes) == compress
+
+    save_sdf(db_fname)
+    sdf_mols = list(Chem.SDMolSupplier(str(tmp_path / 'output.sdf'), removeHs=False))
+    assert len(sdf_mols) == 1
+    assert sdf_mols[0].GetProp('_Name') == 'mol1'
+    assert float(sdf_mols[0].GetProp('docking_score')) == pytest.approx(-5.0)
+    assert sdf_mols[0].GetNumAtoms() == natoms
@@ -1,7 +1,8 @@
 import pytest
+from meeko import PDBQTMolecule, RDKitMolCreate
 from rdkit import Chem
 
-from easydock.preparation_for_docking import pdbqt2molblock
+from easydock.preparation_for_docking import assign_bonds_from_template, pdbqt2molblock
 
 OFFENDING_PDBQT = """MODE 1
 REMARK VINA RESULT:      -9.5      0.000      0.000
@@ -293,3 +294,15 @@ def test_pdbqt_meeko_macrocycle():
     result = pdbqt2molblock(OFFENDING_PDBQT, molecule, "Test-molecule")
 
     assert result is not None
+
+
+def test_assign_bonds_from_template_sanitized():
+    template_mol = Chem.MolFromSmiles(
+        "Cn1nc(C2CCCN2C(=O)OC(C)(C)C)cc1C(=O)NC1CCc2ccccc2NC1=O"
+    )
+    pdbqt_mol = PDBQTMolecule(OFFENDING_PDBQT, is_dlg=False, skip_typing=True, poses_to_read=1)
+    pose_mol = RDKitMolCreate.from_pdbqt_mol(pdbqt_mol)[0]
+    mol = assign_bonds_from_template(template_mol, pose_mol)
+
+    assert Chem.SanitizeMol(mol, catchErrors=True) == Chem.SanitizeFlags.SANITIZE_NONE
+    assert any(atom.GetIsAromatic() for atom in mol.GetAtoms())